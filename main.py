@@ -1,58 +1,47 @@
+import time
+import uuid
 import streamlit as st
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
-import yfinance as yf
-from supabase import create_client, Client
+from supabase import PostgrestAPIError
+import httpx
 import numpy as np
+from mc_sim import simulate
+from nisa_core import (init_supabase, flush_logs, fetch_recent_logs, LOG_COLUMNS,
+                       get_recent_quotes, get_30y_yields, get_fx_50y, EMPTY_FX)
 
 # --- 1. Supabaseの初期設定 ---
-@st.cache_resource
-def init_supabase() -> Client:
-    url = st.secrets["SUPABASE_URL"]
-    key = st.secrets["SUPABASE_KEY"]
-    return create_client(url, key)
-
 try:
     supabase = init_supabase()
 except Exception as e:
+    supabase = None
     st.error(f"Supabase接続エラー: {e}")
 
-# --- 2. 過去の実績データの取得と分析 ---
-@st.cache_data(ttl=86400)
-def get_market_analysis():
-    tickers = {
-        "日経平均 (円)": "^N225",
-        "S&P 500 (USD)": "^GSPC",
-        "オルカン(ACWI) (USD)": "ACWI",
-        "金(Gold) (USD)": "GC=F"
-    }
-    results = {}
-    for name, symbol in tickers.items():
-        try:
-            hist = yf.Ticker(symbol).history(period="30y")['Close']
-            returns = hist.pct_change().dropna()
-            # 幾何平均利回り (CAGR)
-            cagr = (pow(hist.iloc[-1] / hist.iloc[0], 1 / (len(hist)/252)) - 1) * 100
-            # ボラティリティ (年率標準偏差)
-            vol = returns.std() * np.sqrt(252) * 100
-            results[name] = {"cagr": cagr, "vol": vol, "price": hist.iloc[-1]}
-        except:
-            results[name] = {"cagr": 0, "vol": 0, "price": 0}
-    
-    try:
-        fx = yf.Ticker("JPY=X").history(period="max")['Close']
-        fx = fx[fx.index > "1976-01-01"]
-    except:
-        fx = pd.Series()
-        
-    return results, fx
-
-# --- 3. UIの構築 ---
+# --- 2. UIの構築 ---
 st.set_page_config(page_title="新NISA 精密シミュレーター", layout="wide")
 st.title("💰 新NISA 精密シミュレーター (リスク分析版)")
 
-market_stats, fx_hist = get_market_analysis()
+# 取得に失敗した結果はキャッシュされないので、失敗した時刻をセッションに記録し、
+# しばらくは取り直さずに既定値を使う。通信障害のあいだ、ウィジェットを操作する
+# たびにタイムアウトを待たされないようにするため
+MARKET_RETRY_SEC = 300
+
+def load_market_data(fetch, default):
+    failed_at = st.session_state.setdefault("market_failed_at", {})
+    if time.time() - failed_at.get(fetch.__name__, 0.0) < MARKET_RETRY_SEC:
+        return default
+    try:
+        return fetch()
+    except (OSError, KeyError, IndexError, ValueError) as e:
+        failed_at[fetch.__name__] = time.time()
+        st.toast(f"市場データ取得エラー: {e}")
+        return default
+
+# 更新頻度の違うデータごとに別々にキャッシュしている
+market_stats = load_market_data(get_30y_yields, {})
+quotes = load_market_data(get_recent_quotes, {})
+fx_hist, fx_last = load_market_data(get_fx_50y, (EMPTY_FX, None))
+fx_last = quotes.get("ドル円", fx_last)
 
 # サイドバー：ここで変数を定義しています
 st.sidebar.header("📊 シミュレーション設定")
@@ -62,88 +51,93 @@ avg_rate = st.sidebar.slider("想定年率 (%)", 0.1, 15.0, float(round(sp500_re
 vol_rate = st.sidebar.slider("ボラティリティ/リスク (%)", 0.0, 40.0, float(round(sp500_ref["vol"], 1)))
 years = st.sidebar.slider("運用年数 (年)", 1, 50, 20)
 
-# --- 4. モンテカルロ法によるリスクシミュレーション ---
-def simulate_investment_risk(monthly, rate, vol, duration):
-    n_sims = 10000 # 試行回数
-    mu = rate / 100 / 12
-    sigma = vol / 100 / np.sqrt(12)
-    nisa_limit = 18000000
-    
-    all_runs = []
-    for _ in range(n_sims):
-        val = 0
-        principal = 0
-        path = []
-        for m in range(1, duration * 12 + 1):
-            if principal + monthly <= nisa_limit:
-                principal += monthly
-                val += monthly
-            # ランダムなリターンを生成
-            val *= (1 + np.random.normal(mu, sigma))
-            if m % 12 == 0:
-                path.append(val)
-        all_runs.append(path)
-    
-    res_np = np.array(all_runs)
-    years_list = list(range(1, duration + 1))
-    
-    return pd.DataFrame({
-        "年": years_list,
-        "平均値": np.mean(res_np, axis=0),
-        "上位5%": np.percentile(res_np, 95, axis=0),
-        "下位5%": np.percentile(res_np, 5, axis=0),
-        "元本": [min(monthly * 12 * y, nisa_limit) for y in years_list]
-    })
-
+# --- 3. モンテカルロ法によるリスクシミュレーション ---
 # ここで関数を呼び出す（monthly_invが定義された後）
-df_res = simulate_investment_risk(monthly_inv, avg_rate, vol_rate, years)
+df_res, (final_mean, final_hi, final_lo) = simulate(monthly_inv, avg_rate, vol_rate, years,
+                                                   n_sims=10000, q_low=0.05, q_high=0.95)
 
 # メインチャート
 st.subheader(f"📈 {years}年後の予測範囲 (90%信頼区間)")
-st.markdown(f"平均的な結果は **{int(df_res.iloc[-1]['平均値']):,} 円** ですが、"
-            f"90%の確率で **{int(df_res.iloc[-1]['下位5%']):,} 円 〜 {int(df_res.iloc[-1]['上位5%']):,} 円** の範囲に収まると予測されます。")
+st.markdown(f"平均的な結果は **{int(final_mean):,} 円** ですが、"
+            f"90%の確率で **{int(final_lo):,} 円 〜 {int(final_hi):,} 円** の範囲に収まると予測されます。")
+
+# 点数が少なく組み立ては数ミリ秒で終わるので、キャッシュせず毎回組み立てる
+# (st.cache_data に入れると、引数のハッシュと図の複製のほうが高くつく)
+def build_risk_fig(res):
+    # res は simulate の結果と同じ列順 (年, 平均値, 上位, 下位, 元本) の NumPy 配列
+    year, mean, hi, lo, principal = res.T
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=year, y=hi, name="上位5% (好調)", line=dict(width=0), showlegend=False))
+    fig.add_trace(go.Scatter(x=year, y=lo, name="予測範囲 (確率90%)", fill='tonexty', fillcolor='rgba(0,104,201,0.2)', line=dict(width=0)))
+    fig.add_trace(go.Scatter(x=year, y=mean, name="平均的な推移", line=dict(color='#0068c9', width=4)))
+    fig.add_trace(go.Scatter(x=year, y=principal, name="投資元本", line=dict(color='gray', dash='dash')))
 
-fig = go.Figure()
-fig.add_trace(go.Scatter(x=df_res["年"], y=df_res["上位5%"], name="上位5% (好調)", line=dict(width=0), showlegend=False))
-fig.add_trace(go.Scatter(x=df_res["年"], y=df_res["下位5%"], name="予測範囲 (確率90%)", fill='tonexty', fillcolor='rgba(0,104,201,0.2)', line=dict(width=0)))
-fig.add_trace(go.Scatter(x=df_res["年"], y=df_res["平均値"], name="平均的な推移", line=dict(color='#0068c9', width=4)))
-fig.add_trace(go.Scatter(x=df_res["年"], y=df_res["元本"], name="投資元本", line=dict(color='gray', dash='dash')))
+    fig.update_layout(xaxis_title="経過年数", yaxis_title="資産額 (円)", hovermode="x unified")
+    return fig
 
-fig.update_layout(xaxis_title="経過年数", yaxis_title="資産額 (円)", hovermode="x unified")
+# DataFrame を経由せず、数値配列のまま渡してグラフを組み立てる
+fig = build_risk_fig(df_res.to_numpy(dtype=np.float64))
 st.plotly_chart(fig, use_container_width=True)
 
 # 市場実績データ
 st.divider()
 st.subheader("📋 市場実績データ (利回りとリスクの参考)")
-m_cols = st.columns(len(market_stats))
+m_cols = st.columns(max(len(market_stats), 1))
 for i, (name, val) in enumerate(market_stats.items()):
     with m_cols[i]:
-        st.metric(label=name, value=f"{val['price']:,.0f}")
+        st.metric(label=name, value=f"{quotes.get(name, val['price']):,.0f}")
         st.info(f"平均利回り: {val['cagr']:.1f}%\n\nリスク(σ): {val['vol']:.1f}%")
 
 # 50年為替チャート
 st.divider()
 st.subheader("💱 ドル円為替レートの推移 (過去50年)")
+
+# 為替データはスライダー操作では変わらないので、組み立てた図を全セッションで使い回す
+# st.cache_data だと図を毎回複製するため効果がなく、複製しない cache_resource を使う
+# (st.plotly_chart は渡した図を書き換えない)。現在値は1時間ごとに変わるので ttl も揃える
+@st.cache_resource(ttl=3600, show_spinner=False)
+def build_fx_fig(fx_hist, fx_last):
+    # 点数の多い時系列なので SVG ではなく WebGL (Scattergl) で描画する
+    # 年次の予測グラフは点数が少ないため、通常の Scatter のままでよい
+    fig_fx = go.Figure(go.Scattergl(x=fx_hist.index, y=fx_hist.to_numpy(), mode="lines", name="ドル円"))
+    fig_fx.update_layout(xaxis_title="日付", yaxis_title="ドル円 (円)")
+    fig_fx.add_hline(y=fx_last, line_dash="dot", line_color="red", annotation_text=f"現在: {fx_last:.1f}円")
+    return fig_fx
+
 if not fx_hist.empty:
-    fig_fx = px.line(fx_hist)
-    fig_fx.add_hline(y=fx_hist.iloc[-1], line_dash="dot", line_color="red", annotation_text=f"現在: {fx_hist.iloc[-1]:.1f}円")
-    st.plotly_chart(fig_fx, use_container_width=True)
+    st.plotly_chart(build_fx_fig(fx_hist, fx_last), use_container_width=True)
 
 # 保存機能
+if "log_token" not in st.session_state:
+    st.session_state.log_token = uuid.uuid4().hex
+    st.session_state.log_gen = 0
 if st.button("このシミュレーション結果を保存する"):
+    # 保存に失敗した行はキューに残り、次回の保存時にまとめて送られる
+    # 接続できないあいだに何度押しても、同じ内容の行は1つだけ積む
+    pending_logs = st.session_state.setdefault("pending_logs", [])
+    log = {
+        "user_name": "ゲストユーザー", "monthly_investment": monthly_inv, 
+        "annual_rate": avg_rate, "years": years, "final_wealth": int(final_mean)
+    }
+    if log not in pending_logs:
+        pending_logs.append(log)
     try:
-        supabase.table("nisa_logs").insert({
-            "user_name": "ゲストユーザー", "monthly_investment": monthly_inv, 
-            "annual_rate": avg_rate, "years": years, "final_wealth": int(df_res.iloc[-1]["平均値"])
-        }).execute()
+        if supabase is None:
+            raise ValueError("Supabase未接続")
+        flush_logs(supabase, pending_logs)
+        # 保存した行がすぐ履歴に出るよう、このセッションの履歴キャッシュを切り替える
+        st.session_state.log_gen += 1
         st.success("保存完了！")
-    except: st.error("保存失敗")
+    except (PostgrestAPIError, httpx.HTTPError, ValueError) as e:
+        st.error(f"保存失敗: {e}")
 
 # 履歴表示
 st.subheader("💾 最近の保存履歴")
 try:
-    res = supabase.table("nisa_logs").select("*").order("id", desc=True).limit(5).execute()
-    if res.data:
-        st.dataframe(pd.DataFrame(res.data)[["monthly_investment", "annual_rate", "final_wealth", "created_at"]])
-except:
+    if supabase is None:
+        raise ValueError("Supabase未接続")
+    logs = fetch_recent_logs(st.session_state.log_token, st.session_state.log_gen)
+    if logs:
+        st.dataframe(pd.DataFrame(logs)[LOG_COLUMNS])
+except (PostgrestAPIError, httpx.HTTPError, KeyError, ValueError):
     st.warning("履歴を取得できません。")
\ No newline at end of file
@@ -0,0 +1,52 @@
+import streamlit as st
+import pandas as pd
+import numpy as np
+
+# --- モンテカルロ法によるリスクシミュレーション ---
+# 月次の成長率 factors (月数 x 試行数) を各月末の資産額で上書きし、年末の値を返す
+# 全パスを同時に更新するため、Pythonのループは積立期間の月数分だけ
+# 月ごとに1行 (連続したメモリ) を読み書きするよう、月を先頭の軸にしている
+def _simulate_paths(monthly, nisa_limit, factors):
+    months = factors.shape[0]
+    # 生涯投資枠に達する月を先に求め、積立期間と運用のみの期間に分ける
+    fill_month = min(months, nisa_limit // monthly)
+    vals = np.zeros(factors.shape[1])
+    for m in range(fill_month):
+        vals += monthly
+        vals *= factors[m]
+        factors[m] = vals
+    # 枠到達後は複利のみなので、成長率の累積積でまとめて求める
+    growth = np.cumprod(factors[fill_month:], axis=0, out=factors[fill_month:])
+    growth *= vals
+    # 年末の値は12か月ごとのビューで取り出す (コピーなし)
+    return factors[11::12]
+
+# 入力が同じなら再実行のたびにシミュレーションし直さないようキャッシュする
+@st.cache_data(ttl=3600, show_spinner=False)
+def simulate(monthly, rate, vol, duration, n_sims=10000, q_low=0.05, q_high=0.95, seed=0):
+    mu = rate / 100 / 12
+    sigma = vol / 100 / np.sqrt(12)
+    nisa_limit = 18000000
+    
+    months = duration * 12
+    # seedを固定して同じ入力なら同じ結果になるようにする
+    rng = np.random.default_rng(seed)
+    z = rng.standard_normal((months, n_sims), dtype=np.float64)
+    factors = np.multiply(z, sigma, out=z)
+    factors += 1.0 + mu
+
+    res_np = _simulate_paths(monthly, nisa_limit, factors)
+    years_arr = np.arange(1, duration + 1, dtype=np.int64)
+    # 上下の分位点は1回の呼び出しでまとめて求める
+    lo, hi = np.quantile(res_np, [q_low, q_high], axis=1)
+    mean = np.mean(res_np, axis=1)
+    
+    df = pd.DataFrame({
+        "年": years_arr,
+        "平均値": mean,
+        f"上位{1 - q_high:.0%}": hi,
+        f"下位{q_low:.0%}": lo,
+        "元本": np.minimum(monthly * 12 * years_arr, nisa_limit)
+    })
+    # 最終年の値 (平均, 上位, 下位) は配列から直接取り出して一緒に返す
+    return df, (float(mean[-1]), float(hi[-1]), float(lo[-1]))
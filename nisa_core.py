@@ -0,0 +1,201 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+import streamlit as st
+import pandas as pd
+from supabase import create_client, Client, PostgrestAPIError
+import httpx
+import numpy as np
+import pyarrow as pa
+
+# --- 1. Supabaseの初期設定 ---
+@st.cache_resource
+def init_supabase() -> Client:
+    url = st.secrets["SUPABASE_URL"]
+    key = st.secrets["SUPABASE_KEY"]
+    return create_client(url, key)
+
+# 履歴表示に使う列。サーバー側でこの列だけを選んで取得する
+LOG_COLUMNS = ["monthly_investment", "annual_rate", "final_wealth", "created_at"]
+
+# 最近の保存履歴。画面の再実行ごとにDBへ問い合わせないようキャッシュする
+# キャッシュは全セッションで共有されるため、セッション固有の token と
+# そのセッション内の保存回数 gen の組をキーにする。保存のたびに gen を増やすと
+# そのセッションだけ新しいエントリに切り替わる
+# 他のユーザーの保存も反映されるよう、短い ttl も併用する
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_recent_logs(token, gen, limit=5):
+    res = init_supabase().table("nisa_logs").select(",".join(LOG_COLUMNS)) \
+        .order("created_at", desc=True).limit(limit).execute()
+    return res.data
+
+# 溜まっている保存データを1回のinsertでまとめて送り、成功したらキューを空にする
+# キューに残すのは、insert が行われていないと確実に言える失敗のときだけ
+# (接続できなかった、またはサーバーがエラーを返した)。応答待ちのタイムアウトなどは
+# サーバー側で保存済みの可能性があり、送り直すと重複するのでキューから外す
+def flush_logs(client: Client, pending_logs: list) -> None:
+    if not pending_logs:
+        return
+    try:
+        client.table("nisa_logs").insert(pending_logs).execute()
+    except (PostgrestAPIError, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+        raise
+    except httpx.HTTPError:
+        pending_logs.clear()
+        raise
+    pending_logs.clear()
+
+# --- 2. 過去の実績データの取得と分析 ---
+TICKERS = {
+    "日経平均 (円)": "^N225",
+    "S&P 500 (USD)": "^GSPC",
+    "オルカン(ACWI) (USD)": "ACWI",
+    "金(Gold) (USD)": "GC=F"
+}
+
+# 為替データを取得できなかったときに使う空の系列
+EMPTY_FX = pd.Series(dtype="float64", index=pd.DatetimeIndex([]))
+
+# 起動時のカレントディレクトリに左右されないよう、このファイルの隣に置く
+_CACHE_DIR = Path(__file__).parent / ".cache"
+# ディスク上の有効期限 (秒)。直近の値動きは短く、長期の全期間データは長めにとる
+_DISK_TTL = {"5d": 3600, "max": 7 * 86400}
+
+# 銘柄と期間ごとに価格履歴をメモリとディスクの両方にキャッシュする
+# ディスクに保存しておくことで、アプリの再起動後も取得し直さずに済む
+# メモリ上は最短の1時間で切り替え、実際の有効期限はディスク側の期間別TTLで決める
+@st.cache_data(ttl=3600, show_spinner=False)
+def _ticker_history(symbols, period):
+    path = _CACHE_DIR / f"{'_'.join(symbols)}_{period}.parquet"
+    if path.exists() and time.time() - path.stat().st_mtime < _DISK_TTL.get(period, 86400):
+        try:
+            return pd.read_parquet(path)
+        except (OSError, ValueError, pa.ArrowInvalid):
+            # 壊れた・読めないキャッシュファイルは削除して取得し直す
+            path.unlink(missing_ok=True)
+    # yfinance は読み込みが重いので、実際にダウンロードするときだけ import する
+    import yfinance as yf
+    try:
+        data = yf.download(list(symbols), period=period, group_by="ticker",
+                           auto_adjust=True, threads=True, progress=False)
+    except yf.exceptions.YFException as e:
+        raise ValueError(f"価格データを取得できませんでした: {', '.join(symbols)}") from e
+    if data is None or data.empty:
+        raise ValueError(f"価格データを取得できませんでした: {', '.join(symbols)}")
+    # 一部の銘柄だけ取得に失敗した結果はディスクに残さず、次回に取り直す
+    closes = data.xs("Close", axis=1, level=1)
+    if all(symbol in closes and closes[symbol].notna().any() for symbol in symbols):
+        # ディスクへの保存は補助的なもの。書き込めなくても取得したデータはそのまま返す
+        try:
+            _write_cache(data, path)
+        except OSError:
+            pass
+    return data
+
+# 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+def _write_cache(data, path):
+    _CACHE_DIR.mkdir(exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=_CACHE_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        data.to_parquet(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+# 長い時系列を見た目を保ったまま n_out 点に間引く (Largest-Triangle-Three-Buckets)
+# ブラウザに送る点数を減らしてグラフの描画を軽くするため。返り値は残す点の位置
+def _lttb_indices(y, n_out):
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    x = np.arange(n, dtype=np.float64)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # 次のバケットの平均点と、直前に選んだ点とで作る三角形が最大になる点を選ぶ
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        idx[i + 1] = a
+    return idx
+
+# 直近の終値だけを1時間ごとに取り直す (為替の現在値もここで更新する)
+@st.cache_data(ttl=3600)
+def get_recent_quotes():
+    symbols = {**TICKERS, "ドル円": "JPY=X"}
+    data = _ticker_history(tuple(sorted(symbols.values())), "5d")
+    last = data.xs("Close", axis=1, level=1).ffill().iloc[-1]
+    return {name: float(last[symbol]) for name, symbol in symbols.items()
+            if symbol in last and not np.isnan(last[symbol])}
+
+# 一部の銘柄が欠けた結果を1日キャッシュに入れずに呼び出し元へ渡すための例外
+class _IncompleteYields(Exception):
+    def __init__(self, results):
+        super().__init__(results)
+        self.results = results
+
+# 過去30年の利回りとリスクは1日1回の更新で十分
+# ただし1日キャッシュするのは全銘柄がそろった結果だけにする。欠けた結果は
+# 価格履歴側の1時間のキャッシュが切れた後の再実行で取り直される
+def get_30y_yields():
+    try:
+        return _cached_30y_yields()
+    except _IncompleteYields as e:
+        return e.results
+
+@st.cache_data(ttl=86400)
+def _cached_30y_yields():
+    symbols = list(TICKERS.values())
+    # 全銘柄を1回のリクエストでまとめて取得する
+    # 並び順が変わっても同じキャッシュを使えるよう、銘柄はソートして渡す
+    data = _ticker_history(tuple(sorted(symbols)), "30y")
+    # 銘柄ごとに取引日が異なるため、欠損を残したまま列単位でまとめて計算する
+    prices = data.xs("Close", axis=1, level=1).reindex(columns=symbols)
+    # 以降の計算は pandas を経由せず NumPy 配列で行う
+    closes = prices.to_numpy()
+    filled = prices.ffill().to_numpy()
+    valid = ~np.isnan(closes)
+    first_idx = valid.argmax(axis=0)
+    last_idx = len(closes) - 1 - valid[::-1].argmax(axis=0)
+    first = closes[first_idx, np.arange(len(symbols))]
+    last = filled[-1]
+    # 取引日数ではなく、最初と最後の日付の間の暦年数で年率換算する
+    days = (prices.index - prices.index[0]).days.to_numpy()
+    n_years = (days[last_idx] - days[first_idx]) / 365.25
+    with np.errstate(all="ignore"):
+        # 幾何平均利回り (CAGR)
+        cagr = ((last / first) ** (1.0 / n_years) - 1.0) * 100.0
+        # ボラティリティ (年率標準偏差)
+        returns = np.diff(filled, axis=0) / filled[:-1]
+        returns[~valid[1:]] = np.nan
+    # 取得できなかった銘柄は0で埋めずに除外する
+    # 標準偏差 (ddof=1) には日次リターンが2つ以上必要なので、その銘柄だけで計算する
+    # (nanstd の自由度の警告は errstate では抑えられないため)
+    keep = (~np.isnan(returns)).sum(axis=0) > 1
+    vol = np.full(len(symbols), np.nan)
+    vol[keep] = np.nanstd(returns[:, keep], axis=0, ddof=1) * np.sqrt(252) * 100.0
+    results = {name: {"cagr": float(cagr[i]), "vol": float(vol[i]), "price": float(last[i])}
+               for i, name in enumerate(TICKERS) if keep[i]}
+    if not results:
+        raise ValueError("市場データを取得できませんでした")
+    if len(results) < len(TICKERS):
+        raise _IncompleteYields(results)
+    return results
+
+# 50年分の為替はほとんど変わらないので1週間キャッシュし、描画用に間引いた系列と最新値を返す
+@st.cache_data(ttl=7 * 86400)
+def get_fx_50y():
+    fx = _ticker_history(("JPY=X",), "max")["JPY=X"]["Close"].dropna()
+    # 日付の比較用に Timestamp を一度だけ作り、ソート済みの index を二分探索で切り出す
+    fx = fx.loc[pd.Timestamp("1976-01-01", tz=fx.index.tz):]
+    if fx.empty:
+        raise ValueError("為替データを取得できませんでした")
+    # 約1.3万点の日次データをそのまま描画すると重いので、2000点に間引く
+    return fx.iloc[_lttb_indices(fx.to_numpy(), 2000)], float(fx.iloc[-1])